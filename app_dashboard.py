@@ -9,13 +9,22 @@ Esegui con: streamlit run app_dashboard.py
 
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-from sqlalchemy import create_engine
+import numpy as np
+import connectorx as cx
 import logging
+from sqlalchemy import Integer, String, text, bindparam
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.dialects import postgresql
 
-from db_config import get_db_engine
+from db_config import get_db_engine, get_db_dsn
 from country_codes import eurostat_dictionary
 
+# Oltre questa soglia di punti il grafico della disoccupazione viene ricampionato
+RESAMPLE_THRESHOLD = 5000
+
+# Etichette leggibili delle fasce d'età della disoccupazione
+UNEMP_AGE_LABELS = {'Y15-29': 'Giovani (15-29)', 'Y15-74': 'Totale (15-74)'}
+
 # Configura Logging
 logging.basicConfig(level=logging.INFO)
 
@@ -27,17 +36,198 @@ def get_db_engine_cached():
     """Restituisce una connessione al database engine nella cache."""
     return get_db_engine()
 
-@st.cache_data
-def get_data_from_db(query):
+@st.cache_data(ttl=600, show_spinner=False)
+def _query_db(query, params=None):
+    """
+    Esegue una query SQL parametrizzata e restituisce il risultato come DataFrame.
+    I parametri di tipo lista/tupla vengono espansi (es. `geo IN :geos`).
+
+    La lettura passa da connectorx: il protocollo binario di Postgres viene decodificato
+    direttamente in Arrow, senza materializzare una tupla Python per riga.
+    Le eccezioni vengono propagate, quindi un errore non finisce mai in cache.
     """
-    Esegue una query SQL e restituisce il risultato come DataFrame.
+    stmt = text(query)
+    if params:
+        # Gli IN espansi vanno tipizzati, altrimenti literal_binds non sa rendere i valori (NullType)
+        expanding = [
+            bindparam(k, expanding=True, type_=Integer() if v and isinstance(v[0], int) else String())
+            for k, v in params.items() if isinstance(v, (list, tuple))
+        ]
+        if expanding:
+            stmt = stmt.bindparams(*expanding)
+        stmt = stmt.bindparams(**params)
+    # connectorx accetta solo SQL testuale: SQLAlchemy rende i parametri come letterali quotati
+    sql = str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    return cx.read_sql(get_db_dsn(), sql, return_type="arrow").to_pandas()
+
+def get_data_from_db(query, params=None):
+    """
+    Restituisce il risultato della query come DataFrame (in cache per 10 minuti),
+    oppure None se la query fallisce: i chiamanti distinguono così "nessun dato" da "errore".
     """
     try:
-        engine = get_db_engine_cached()
-        return pd.read_sql(query, engine)
+        return _query_db(query, params)
     except Exception as e:
+        logging.exception("Query failed")
         st.error(f"Error executing query: {query}\nError: {e}")
-        return pd.DataFrame()
+        return None
+
+@st.cache_data(ttl=3600)
+def get_filter_domain():
+    """
+    Restituisce (all_countries, min_year, max_year) per popolare i filtri della sidebar.
+    Il dominio cambia solo con l'ETL, quindi viene ricaricato al massimo una volta all'ora.
+    Gli errori vengono propagati (e quindi non messi in cache) al chiamante.
+    """
+    # Nota: Usiamo 'unemployment' come base per il range paese/anno dato che è un dataset chiave
+    # Aggregazioni lato server: ~30 righe + 1 riga invece dell'intero prodotto (geo, year)
+    # Risultati minuscoli: fetchall diretto, senza costruire DataFrame
+    engine = get_db_engine_cached()
+    with engine.connect() as conn:
+        geos = [row.geo for row in conn.execute(text("SELECT DISTINCT geo FROM unemployment")).fetchall()]
+        min_year, max_year = conn.execute(text("SELECT MIN(year), MAX(year) FROM unemployment")).one()
+
+    if not geos:
+        return [], 2010, 2023
+
+    all_countries = sorted(geos, key=lambda x: eurostat_dictionary.get(x, x))
+    return all_countries, int(min_year), int(max_year)
+
+def map_labels(series, mapping):
+    """
+    Traduce i codici di una colonna tramite `mapping`, lasciando invariati i codici sconosciuti.
+    Il lookup avviene una volta per categoria (codice distinto) invece che per riga.
+    """
+    codes = series.astype('category')
+    labels = codes.cat.categories.map(lambda c: mapping.get(c, c))
+    if labels.is_unique:
+        return codes.cat.rename_categories(labels)
+    # Etichette duplicate (es. codice sconosciuto uguale a un nome): nessuna categoria valida
+    return pd.Series(labels.take(codes.cat.codes, allow_fill=True, fill_value=np.nan), index=series.index)
+
+def is_valid_geo_code(code):
+    """I codici geo Eurostat contengono solo lettere, cifre e '_' (es. 'EU27_2020')."""
+    return bool(code) and all(c.isalnum() or c == '_' for c in code)
+
+def split_sources(df):
+    """
+    Divide il risultato della query unificata in un DataFrame per sorgente ('src').
+    Le sorgenti senza righe ricevono un DataFrame vuoto con le stesse colonne.
+    """
+    columns = ['geo', 'year', 'age', 'value']
+    frames = {src: pd.DataFrame(columns=columns) for src in ('unemp', 'poverty', 'home')}
+    if df.empty:
+        return frames
+    for src, group in df.groupby('src', sort=False):
+        frames[src] = group.drop(columns='src').reset_index(drop=True)
+    return frames
+
+# --- Costruzione Grafici ---
+# Le figure sono in cache come dict (picklabili): se i dati non cambiano tra un rerun e l'altro
+# si evita di ricostruire e serializzare la figura Plotly. st.plotly_chart accetta direttamente il dict.
+# plotly.express è importato nei singoli builder: non serve per il primo render della sidebar.
+# La chiave di cache è il contenuto del DataFrame: ttl e max_entries limitano le figure tenute
+# in memoria (ogni combinazione di paesi/anni ne aggiungerebbe una) su un server di lunga durata.
+FIG_CACHE_ENTRIES = 32
+
+def _label_unemp(df):
+    """Aggiunge nome del paese ed etichetta della fascia d'età ai dati sulla disoccupazione."""
+    return df.assign(
+        country_name=map_labels(df['geo'], eurostat_dictionary),
+        age_label=map_labels(df['age'], UNEMP_AGE_LABELS),
+    )
+
+@st.cache_data(ttl=600, max_entries=FIG_CACHE_ENTRIES, show_spinner=False)
+def _build_unemp_fig(df):
+    """Grafico a linee della disoccupazione (Giovani vs Totale) per paese."""
+    import plotly.express as px
+
+    df = _label_unemp(df)
+
+    fig = px.line(
+        df, 
+        x='year', 
+        y='value', 
+        color='country_name', 
+        line_dash='age_label', 
+        title='Tasso di Disoccupazione (Giovani vs Totale)',
+        labels={'value': 'Tasso di Disoccupazione (%)', 'year': 'Anno', 'country_name': 'Paese', 'age_label': 'Fascia Età'},
+        render_mode='webgl' # Tracce scattergl: il rendering scala col numero di punti senza nodi SVG
+    )
+    # Sotto soglia il ricampionamento costerebbe più del rendering diretto
+    if len(df) > RESAMPLE_THRESHOLD:
+        try:
+            # Dipendenza opzionale (pip install plotly-resampler): downsampling LTTB per serie molto lunghe
+            from plotly_resampler import FigureResampler
+            fig = FigureResampler(fig, default_n_shown_samples=2000)
+        except ImportError:
+            pass
+    return fig.to_dict()
+
+@st.cache_data(ttl=600, max_entries=FIG_CACHE_ENTRIES, show_spinner=False)
+def _build_unemp_year_fig(df, year):
+    """Grafico a barre della disoccupazione per un singolo anno (una linea sarebbe degenere)."""
+    import plotly.express as px
+
+    df = _label_unemp(df)
+
+    fig = px.bar(
+        df,
+        x='country_name',
+        y='value',
+        color='age_label',
+        barmode='group',
+        title=f'Tasso di Disoccupazione (Giovani vs Totale, {year})',
+        labels={'value': 'Tasso di Disoccupazione (%)', 'country_name': 'Paese', 'age_label': 'Fascia Età'}
+    )
+    return fig.to_dict()
+
+@st.cache_data(ttl=600, max_entries=FIG_CACHE_ENTRIES, show_spinner=False)
+def _build_poverty_fig(df, year):
+    """Grafico a barre del rischio di povertà per fascia d'età nell'anno indicato."""
+    import plotly.express as px
+
+    # Map codes to readable labels
+    label_map_pov = {'Y16-29': 'Giovani (16-29)', 'Y25-64': 'Adulti (25-64)'}
+    df = df.assign(
+        country_name=map_labels(df['geo'], eurostat_dictionary),
+        age_label=map_labels(df['age_group'], label_map_pov),
+    )
+
+    fig = px.bar(
+        df, 
+        x='country_name', 
+        y='value', 
+        color='age_label', 
+        barmode='group',
+        title=f'Tasso di Rischio di Povertà ({year})',
+        labels={'value': 'Tasso (%)', 'country_name': 'Paese', 'age_label': 'Fascia Età'}
+    )
+    return fig.to_dict()
+
+@st.cache_data(ttl=600, max_entries=FIG_CACHE_ENTRIES, show_spinner=False)
+def _build_home_fig(df, selected):
+    """Grafico a barre dell'età di uscita di casa, con i paesi selezionati evidenziati."""
+    import plotly.express as px
+
+    # Ultimo anno disponibile
+    latest_home_year = df['year'].max()
+    # Le righe arrivano già ordinate per valore dal DB
+    df = df.assign(
+        color=np.where(df['geo'].isin(set(selected)), 'Selezionati', 'Altri'),
+        country_name=map_labels(df['geo'], eurostat_dictionary),
+    )
+
+    fig = px.bar(
+        df,
+        x='country_name',
+        y='value',
+        color='color',
+        title=f"Età Media di Uscita di Casa ({latest_home_year})",
+        labels={'value': 'Età (Anni)', 'country_name': 'Paese'},
+        color_discrete_map={'Selezionati': 'red', 'Altri': 'lightgrey'}
+    )
+    return fig.to_dict()
 
 def main():
     st.title("📊 Analisi del Gap Economico Generazionale")
@@ -49,25 +239,15 @@ def main():
     # --- Filtri Sidebar ---
     st.sidebar.header("Filtri")
     
-    # 1. Recupera prima paesi e anni disponibili (Query leggere)
-    # Interroghiamo colonne specifiche per evitare di caricare interi dataset solo per i filtri
-    # Nota: Usiamo 'unemployment' come base per il range paese/anno dato che è un dataset chiave
+    # 1. Recupera prima paesi e anni disponibili (Query leggere, in cache)
     try:
-        filter_query = "SELECT DISTINCT geo, year FROM unemployment"
-        df_filters = get_data_from_db(filter_query)
-        
-        if not df_filters.empty:
-            all_countries = sorted(df_filters['geo'].unique(), key=lambda x: eurostat_dictionary.get(x, x))
-            min_year = int(df_filters['year'].min())
-            max_year = int(df_filters['year'].max())
-        else:
-            all_countries = []
-            min_year, max_year = 2010, 2023
-        min_year, max_year = 2010, 2023
-    except:
-        # Fallback se la tabella non esiste ancora
-        all_countries = []
-        min_year, max_year = 2010, 2023
+        all_countries, min_year, max_year = get_filter_domain()
+    except SQLAlchemyError:
+        # Database irraggiungibile o tabella non ancora creata: inutile proseguire
+        # con altre query destinate a fallire (ognuna può attendere il timeout TCP)
+        logging.exception("Failed to load filter domain")
+        st.error("Impossibile caricare i filtri dal database. Verifica la connessione e che l'ETL sia stato eseguito.")
+        st.stop()
     
     # 2. Recupera fasce d'età disponibili per il filtro
     # Rimosso come richiesto dall'utente (Hardcoded Under 30 vs Totale)
@@ -90,64 +270,87 @@ def main():
         st.warning("Seleziona almeno un paese.")
         return
 
+    # I codici finiscono nel testo SQL inviato a connectorx: scarta subito input inattesi
+    if not all(is_valid_geo_code(c) for c in selected_countries):
+        st.error("Selezione paesi non valida.")
+        return
+
     # Filtro Intervallo Anni
     selected_years = st.sidebar.slider("Seleziona Intervallo Anni", min_year, max_year, (min_year, max_year))
 
     # Filtro Età RIMOSSO
     # selected_ages = st.sidebar.multiselect("Seleziona Fasce d'Età (Disoccupazione/Povertà)", all_ages, default=default_age)
     
-    # Formatta lista per clausola SQL IN
-    countries_sql = "'" + "','".join(selected_countries) + "'"
-    # ages_sql = "'" + "','".join(selected_ages) + "'"
+    # Uscita di casa: di default solo i paesi selezionati (meno righe e meno barre da disegnare)
+    show_all_home = st.sidebar.toggle("Mostra tutti i paesi per contesto (Uscita di Casa)", value=False)
 
-    # --- Caricamento Dati con Query Esplicite ---
-    
-    # Query 1: Disoccupazione
-    # Recupero solo dati rilevanti per i filtri selezionati
-    query_unemp = f"""
-        SELECT geo, year, age, value 
-        FROM unemployment 
-        WHERE geo IN ({countries_sql}) 
-        AND year BETWEEN {selected_years[0]} AND {selected_years[1]}
-        AND age IN ('Y15-29', 'Y15-74') -- Under 30 vs Totale (Popolazione Attiva Y15-74 è standard per tasso Totale)
-        AND sex = 'T'
-        AND unit = 'PC_ACT'
-    """
-    df_unemp = get_data_from_db(query_unemp)
-
-    # Query 2: Povertà
-    # Recupero per l'ultimo anno selezionato
-    query_poverty = f"""
-        SELECT geo, year, 
-               CASE 
-                   WHEN age IN ('Y25-54', 'Y50-64') THEN 'Y25-64' -- Approssimazione per 30-70
-                   ELSE age 
-               END as age_group,
-               sex, unit, AVG(value) as value
-        FROM poverty_risk 
-        WHERE geo IN ({countries_sql}) 
-        AND year = {selected_years[1]}
-        AND age IN ('Y16-29', 'Y25-54', 'Y50-64') -- Giovani vs Età Media
-        AND sex = 'T'
-        AND unit = 'PC' -- Percentuale
-        GROUP BY geo, year, age_group, sex, unit
-    """
-    df_poverty = get_data_from_db(query_poverty)
-
-    # Query 3: Uscita di Casa
-    # Recupero per l'ultimo anno disponibile nell'intervallo (o semplicemente l'ultimo)
-    query_home = f"""
-        SELECT geo, year, value 
-        FROM leaving_home 
-        WHERE year = (SELECT MAX(year) FROM leaving_home WHERE year <= {selected_years[1]})
-        AND sex = 'T'
-        AND unit = 'AVG'
+    # Parametri condivisi dalle query (bind parameters: niente interpolazione di stringhe)
+    query_params = {
+        "geos": list(selected_countries),
+        "y0": selected_years[0],
+        "y1": selected_years[1],
+        "home_all": show_all_home,
+    }
+
+    # --- Caricamento Dati con un'unica Query ---
+    # Le tre sorgenti vengono unite con UNION ALL (colonna discriminante 'src'):
+    # un solo round-trip e un solo DataFrame da costruire per ogni rerun.
+    #
+    # u: Disoccupazione - solo dati rilevanti per i filtri selezionati
+    # p: Povertà - per l'ultimo anno selezionato
+    # h: Uscita di Casa - per l'ultimo anno disponibile nell'intervallo
+    #    Solo i paesi selezionati, a meno che l'utente non chieda tutti i paesi per contesto.
+    #    'latest' risolve l'anno una volta sola: con leaving_home_filter_idx (year, ...) il MAX
+    #    diventa una lettura all'indietro dell'indice con LIMIT 1 (vedi db_migrations.py).
+    #
+    # L'ORDER BY finale ordina l'uscita di casa per valore decrescente (ordine delle barre)
+    # e le altre sorgenti per paese/età/anno (ordine dei punti delle linee). Sta sulla subquery:
+    # su una UNION Postgres accetta solo nomi di colonna, non l'espressione CASE.
+    dashboard_query = """
+        WITH u AS (
+            SELECT 'unemp' AS src, geo, year, age, value 
+            FROM unemployment 
+            WHERE geo IN :geos 
+            AND year BETWEEN :y0 AND :y1
+            AND age IN ('Y15-29', 'Y15-74') -- Under 30 vs Totale (Popolazione Attiva Y15-74 è standard per tasso Totale)
+            AND sex = 'T'
+            AND unit = 'PC_ACT'
+        ),
+        p AS (
+            SELECT 'poverty' AS src, geo, year, age_group AS age, value
+            FROM poverty_risk_grouped -- Vista materializzata: Y25-54/Y50-64 già accorpati in Y25-64 (vedi db_migrations.py)
+            WHERE geo IN :geos 
+            AND year = :y1
+            AND age_group IN ('Y16-29', 'Y25-64') -- Giovani vs Età Media
+            AND sex = 'T'
+            AND unit = 'PC' -- Percentuale
+        ),
+        latest AS (
+            SELECT MAX(year) AS y FROM leaving_home WHERE year <= :y1
+        ),
+        h AS (
+            SELECT 'home' AS src, lh.geo, lh.year, NULL::text AS age, lh.value 
+            FROM leaving_home lh
+            JOIN latest ON lh.year = latest.y
+            WHERE (:home_all OR lh.geo IN :geos)
+            AND lh.sex = 'T'
+            AND lh.unit = 'AVG'
+        )
+        SELECT * FROM (
+            SELECT * FROM u
+            UNION ALL SELECT * FROM p
+            UNION ALL SELECT * FROM h
+        ) s
+        ORDER BY src, CASE WHEN src = 'home' THEN value END DESC, geo, age, year
     """
-    # Nota: Per l'uscita di casa potremmo voler vedere tutti i paesi per contesto, o solo i selezionati? 
-    # Continuiamo a recuperare tutto per fare il confronto evidenziato.
-    # La logica precedente mostrava tutti i paesi con evidenziazione.
-    # Ottimizziamo recuperando tutto per l'ultimo anno per mantenere quella visuale.
-    df_home = get_data_from_db(query_home)
+    df_all = get_data_from_db(dashboard_query, query_params)
+    if df_all is None:
+        # Errore già mostrato: evita di disegnare pannelli "nessun dato" fuorvianti
+        return
+    frames = split_sources(df_all)
+    df_unemp = frames['unemp']
+    df_poverty = frames['poverty'].rename(columns={'age': 'age_group'})
+    df_home = frames['home'].drop(columns='age')
 
 
     # --- Visualizzazioni ---
@@ -158,30 +361,12 @@ def main():
     st.markdown("Confronto tra il tasso di disoccupazione dei giovani (15-29) e quello della popolazione totale.")
     
     if not df_unemp.empty:
-        # I dati sono già filtrati dalla query SQL
-        filtered_unemp = df_unemp
-        
-        # Assicura che 'value' sia numerico
-        filtered_unemp = filtered_unemp.copy()
-        filtered_unemp['value'] = pd.to_numeric(filtered_unemp['value'], errors='coerce')
-        
-        # Mappa codice geo al nome
-        filtered_unemp['country_name'] = filtered_unemp['geo'].map(eurostat_dictionary).fillna(filtered_unemp['geo'])
-        
-        if not filtered_unemp.empty:
-            # Mappa codici a etichette leggibili
-            label_map = {'Y15-29': 'Giovani (15-29)', 'Y15-74': 'Totale (15-74)'}
-            filtered_unemp['age_label'] = filtered_unemp['age'].map(label_map).fillna(filtered_unemp['age'])
-            
-            fig_unemp = px.line(
-                filtered_unemp, 
-                x='year', 
-                y='value', 
-                color='country_name', 
-                line_dash='age_label', 
-                title='Tasso di Disoccupazione (Giovani vs Totale)',
-                labels={'value': 'Tasso di Disoccupazione (%)', 'year': 'Anno', 'country_name': 'Paese', 'age_label': 'Fascia Età'}
-            )
+        # I dati sono già filtrati dalla query SQL e 'value' arriva già numerico dal DB
+        if selected_years[0] == selected_years[1]:
+            # Un solo anno: serie temporale degenere, mostriamo un confronto a barre
+            fig_unemp = _build_unemp_year_fig(df_unemp, selected_years[1])
+        else:
+            fig_unemp = _build_unemp_fig(df_unemp)
         st.plotly_chart(fig_unemp, width='stretch') # Fixed deprecation
     else:
         st.info("Nessun dato sulla disoccupazione disponibile.")
@@ -193,32 +378,9 @@ def main():
     
     if not df_poverty.empty:
         # I dati sono già filtrati dalla query SQL (per ultimo anno e paesi)
-        filtered_pov = df_poverty
-        
         # Determina l'anno effettivamente recuperato (dai dati)
-        latest_year = filtered_pov['year'].max() if not filtered_pov.empty else selected_years[1]
-        
-        if not filtered_pov.empty:
-             filtered_pov['country_name'] = filtered_pov['geo'].map(eurostat_dictionary).fillna(filtered_pov['geo'])
-        if not filtered_pov.empty:
-             filtered_pov['country_name'] = filtered_pov['geo'].map(eurostat_dictionary).fillna(filtered_pov['geo'])
-             
-             # Map codes to readable labels
-             label_map_pov = {'Y16-29': 'Giovani (16-29)', 'Y25-64': 'Adulti (25-64)'}
-             filtered_pov['age_label'] = filtered_pov['age_group'].map(label_map_pov).fillna(filtered_pov['age_group'])
-             
-             fig_pov = px.bar(
-                filtered_pov, 
-                x='country_name', 
-                y='value', 
-                color='age_label', 
-                barmode='group',
-                title=f'Tasso di Rischio di Povertà ({latest_year})',
-                labels={'value': 'Tasso (%)', 'country_name': 'Paese', 'age_label': 'Fascia Età'}
-            )
-             st.plotly_chart(fig_pov, width='stretch') # Fixed deprecation
-        else:
-            st.warning(f"Nessun dato sulla povertà trovato per i paesi selezionati nell'anno {selected_years[1]}.")
+        latest_year = df_poverty['year'].max()
+        st.plotly_chart(_build_poverty_fig(df_poverty, latest_year), width='stretch') # Fixed deprecation
     else:
         st.info("Nessun dato sulla povertà disponibile.")
 
@@ -228,26 +390,7 @@ def main():
     st.markdown("Età media stimata in cui i giovani lasciano il nucleo familiare.")
     
     if not df_home.empty:
-        # Ultimo anno disponibile
-        latest_home_year = df_home['year'].max()
-        # Confronta paesi selezionati vs Media UE (se disponibile) o solo tra loro
-        # Per contesto, mostriamo tutti i paesi ma evidenziamo i selezionati
-        
-        df_home['color'] = df_home['geo'].apply(lambda x: 'Selezionati' if x in selected_countries else 'Altri')
-        df_home['country_name'] = df_home['geo'].map(eurostat_dictionary).fillna(df_home['geo'])
-        # Ordina per valore
-        df_home_sorted = df_home.sort_values('value', ascending=False)
-
-        fig_home = px.bar(
-            df_home_sorted,
-            x='country_name',
-            y='value',
-            color='color',
-            title=f"Età Media di Uscita di Casa ({latest_home_year})",
-            labels={'value': 'Età (Anni)', 'country_name': 'Paese'},
-            color_discrete_map={'Selezionati': 'red', 'Altri': 'lightgrey'}
-        )
-        st.plotly_chart(fig_home, width='stretch')
+        st.plotly_chart(_build_home_fig(df_home, tuple(selected_countries)), width='stretch')
     else:
         st.info("Nessun dato sull'età di uscita di casa.")
 
@@ -4,22 +4,20 @@ Configurazione Database
 Configurazione centralizzata per la connessione PostgreSQL.
 """
 
-from sqlalchemy import create_engine
+from functools import lru_cache
 import logging
-
-
-from dotenv import load_dotenv
 import os
 
 from dotenv import load_dotenv
-import os
+from sqlalchemy import create_engine
 import streamlit as st
 
-# Carica variabili d'ambiente dal file .env
-load_dotenv()
-
+@lru_cache(maxsize=1)
 def get_db_config():
-    """Recupera configurazione database da st.secrets (priorità) o .env."""
+    """
+    Recupera configurazione database da st.secrets (priorità) o .env.
+    Il risultato è in cache: secrets e .env vengono letti una sola volta per processo.
+    """
     # 1. Prova Streamlit Secrets
     try:
         if st.secrets and "postgres" in st.secrets:
@@ -29,7 +27,8 @@ def get_db_config():
     except Exception:
          pass
 
-    # 2. Fallback su Variabili d'Ambiente
+    # 2. Fallback su Variabili d'Ambiente (caricate dal file .env solo qui, al primo utilizzo)
+    load_dotenv()
     return {
         'user': os.getenv('DB_USER'),
         'password': os.getenv('DB_PASSWORD'),
@@ -39,8 +38,8 @@ def get_db_config():
         'sslmode': os.getenv('DB_SSLMODE', 'require')
     }
 
-def get_db_engine():
-    """Crea e restituisce un engine SQLAlchemy."""
+def get_db_url():
+    """Costruisce l'URL PostgreSQL (senza parametri di connessione) dalla configurazione."""
     config = get_db_config()
     
     # Costruisci URL basato sulla sorgente
@@ -54,12 +53,30 @@ def get_db_engine():
 
     # Gestisci tipo porta (int vs string)
     port = str(config.get('port', 5432))
-    sslmode = config.get('sslmode', 'require')
     
-    url = f"postgresql://{config['user']}:{config['password']}@{config['host']}:{port}/{config['dbname']}?sslmode={sslmode}"
+    return f"postgresql://{config['user']}:{config['password']}@{config['host']}:{port}/{config['dbname']}"
+
+def get_db_dsn():
+    """URL completo di sslmode, per i client che non passano da SQLAlchemy (es. connectorx)."""
+    sslmode = get_db_config().get('sslmode', 'require')
+    return f"{get_db_url()}?sslmode={sslmode}"
+
+def get_db_engine():
+    """Crea e restituisce un engine SQLAlchemy."""
+    url = get_db_url()
+    sslmode = get_db_config().get('sslmode', 'require')
     
     try:
-        engine = create_engine(url)
+        # Pool piccolo e riutilizzato: evita handshake TLS+auth ad ogni query.
+        # pool_pre_ping scarta le connessioni inattive chiuse dal server prima di usarle.
+        engine = create_engine(
+            url,
+            pool_size=2,
+            max_overflow=4,
+            pool_pre_ping=True,
+            pool_recycle=1800,
+            connect_args={"sslmode": sslmode, "application_name": "eurostat_dashboard"},
+        )
         return engine
     except Exception as e:
         logging.error(f"Failed to create database engine: {e}")
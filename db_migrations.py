@@ -0,0 +1,96 @@
+"""
+Migrazioni Database
+-------------------
+DDL per le strutture di supporto alla dashboard (viste materializzate e indici).
+Tutte le istruzioni sono idempotenti, quindi lo script può essere rieseguito in sicurezza.
+
+Esegui con: python db_migrations.py
+"""
+
+import logging
+
+from db_config import get_db_engine
+
+# Vista materializzata con l'aggregazione della povertà già calcolata:
+# la dashboard legge righe già raggruppate invece di rifare GROUP BY/AVG ad ogni rerun.
+POVERTY_VIEW_DDL = """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS poverty_risk_grouped AS
+    SELECT geo, year,
+           CASE
+               WHEN age IN ('Y25-54', 'Y50-64') THEN 'Y25-64' -- Approssimazione per 30-70
+               ELSE age
+           END AS age_group,
+           sex, unit, AVG(value) AS value
+    FROM poverty_risk
+    WHERE age <> 'Y25-64' -- Evita di mescolare un eventuale codice nativo con l'approssimazione
+    GROUP BY 1, 2, 3, 4, 5
+"""
+
+# Indice univoco: serve le ricerche (geo, year, age_group) e abilita REFRESH ... CONCURRENTLY
+POVERTY_VIEW_INDEX_DDL = """
+    CREATE UNIQUE INDEX IF NOT EXISTS poverty_risk_grouped_key
+    ON poverty_risk_grouped (geo, year, age_group, sex, unit)
+"""
+
+# Indici compositi sulle tabelle base, nome -> (tabella, colonne).
+# Colonne in uguaglianza prima, colonna di range (year BETWEEN) per ultima;
+# INCLUDE rende l'indice coprente, così Postgres può fare index-only scan.
+INDEXES = {
+    'unemployment_filter_idx': ('unemployment', "(geo, age, sex, unit, year) INCLUDE (value)"),
+    'poverty_risk_filter_idx': ('poverty_risk', "(geo, year, age, sex, unit) INCLUDE (value)"),
+    'leaving_home_filter_idx': ('leaving_home', "(year, sex, unit) INCLUDE (geo, value)"),
+}
+
+def create_indexes(conn, concurrently=False):
+    """
+    Crea gli indici sulle tabelle base se non esistono.
+    Con concurrently=True non blocca le scritture, ma richiede una connessione in AUTOCOMMIT.
+    """
+    mode = "CONCURRENTLY " if concurrently else ""
+    for name, (table, columns) in INDEXES.items():
+        conn.exec_driver_sql(f"CREATE INDEX {mode}IF NOT EXISTS {name} ON {table} {columns}")
+
+def staging_index_ddl(table_name):
+    """
+    DDL degli indici previsti per `table_name`, da creare sulla tabella di staging `{table_name}_stg`
+    (col suffisso _stg). Eseguito dopo il COPY: Postgres costruisce l'indice con un unico ordinamento
+    invece di aggiornarlo riga per riga.
+    """
+    return [
+        f"CREATE INDEX {name}_stg ON {table_name}_stg {columns}"
+        for name, (table, columns) in INDEXES.items() if table == table_name
+    ]
+
+def staging_index_renames(table_name):
+    """Istruzioni che, dopo lo scambio delle tabelle, tolgono il suffisso _stg agli indici di `table_name`."""
+    return [
+        f"ALTER INDEX {name}_stg RENAME TO {name}"
+        for name, (table, _) in INDEXES.items() if table == table_name
+    ]
+
+# Viste materializzate: nome -> (tabella di origine, DDL della vista e dei suoi indici in ordine)
+VIEWS = {
+    'poverty_risk_grouped': ('poverty_risk', [POVERTY_VIEW_DDL, POVERTY_VIEW_INDEX_DDL]),
+}
+
+def views_on(table_names):
+    """Nomi delle viste materializzate costruite su una delle tabelle `table_names`."""
+    return [name for name, (table, _) in VIEWS.items() if table in table_names]
+
+def create_views(conn):
+    """Crea le viste materializzate (se non esistono) con i relativi indici."""
+    for _, ddl in VIEWS.values():
+        for statement in ddl:
+            conn.exec_driver_sql(statement)
+
+def apply_migrations(engine):
+    """Applica tutte le migrazioni su un database in uso (indici creati CONCURRENTLY)."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        create_indexes(conn, concurrently=True)
+        create_views(conn)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.info("Applying database migrations...")
+    apply_migrations(get_db_engine())
+    logging.info("Migrations applied.")
@@ -1,14 +1,11 @@
 
-import pandas as pd
 from db_config import get_db_engine
 
-def check_poverty_age_codes():
-    engine = get_db_engine()
-    
+def check_poverty_age_codes(conn):
     print("\n--- Poverty Age Codes List ---")
     try:
-        df_p = pd.read_sql("SELECT DISTINCT age FROM poverty_risk", engine)
-        codes = sorted(df_p['age'].tolist())
+        rows = conn.exec_driver_sql("SELECT DISTINCT age FROM poverty_risk").fetchall()
+        codes = sorted(row.age for row in rows)
         print(codes)
         
         # Check if there are any that overlap 30-70
@@ -19,4 +16,6 @@ def check_poverty_age_codes():
         print(e)
 
 if __name__ == "__main__":
-    check_poverty_age_codes()
+    # AUTOCOMMIT: una query fallita non invalida la connessione per i controlli successivi
+    with get_db_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        check_poverty_age_codes(conn)
@@ -0,0 +1,16 @@
+"""
+Esegue tutti i controlli di debug sul database riutilizzando un'unica connessione
+(un solo handshake TLS+auth, nessun DataFrame).
+
+Esegui con: python debug_main.py
+"""
+
+from db_config import get_db_engine
+from debug_filters import check_poverty_age_codes
+from debug_poverty_dupes import check_poverty_duplicates
+
+if __name__ == "__main__":
+    # AUTOCOMMIT: una query fallita non invalida la connessione per i controlli successivi
+    with get_db_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        check_poverty_age_codes(conn)
+        check_poverty_duplicates(conn)
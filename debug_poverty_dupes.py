@@ -1,10 +1,11 @@
 
-import pandas as pd
+from tabulate import tabulate
 from db_config import get_db_engine
 
-def check_poverty_duplicates():
-    engine = get_db_engine()
-    
+def print_rows(result):
+    print(tabulate(result.fetchall(), headers=list(result.keys())))
+
+def check_poverty_duplicates(conn):
     print("\n--- Check Duplicate Poverty Data for Italy 2022 (Y16-29) ---")
     query = """
         SELECT year, age, value, sex, unit 
@@ -15,8 +16,7 @@ def check_poverty_duplicates():
         AND sex = 'T'
     """
     try:
-        df = pd.read_sql(query, engine)
-        print(df)
+        print_rows(conn.exec_driver_sql(query))
     except Exception as e:
         print(e)
         
@@ -30,10 +30,11 @@ def check_poverty_duplicates():
         AND sex = 'T'
     """
     try:
-        df_t = pd.read_sql(query_total, engine)
-        print(df_t)
+        print_rows(conn.exec_driver_sql(query_total))
     except Exception as e:
         print(e)
 
 if __name__ == "__main__":
-    check_poverty_duplicates()
+    # AUTOCOMMIT: una query fallita non invalida la connessione per i controlli successivi
+    with get_db_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        check_poverty_duplicates(conn)
@@ -8,25 +8,274 @@ Questo script scarica, pulisce e carica i seguenti dataset in un database Postgr
 4. tessi161: Tasso di sovraccarico del costo dell'alloggio
 
 Requisiti:
-    pip install eurostat pandas sqlalchemy psycopg2-binary
+    pip install aiohttp pandas pyarrow pgpq sqlalchemy psycopg2-binary
 """
 
-import eurostat
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import closing
+import multiprocessing
+import queue
+import threading
+from datetime import date
+import gzip
+import hashlib
+import io
+import json
+import re
+from pathlib import Path
+import xml.etree.ElementTree as ET
+
+import aiohttp
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine
+import pyarrow as pa
+from pgpq import ArrowToPostgresBinaryEncoder
 import logging
 
 from db_config import get_db_engine
+from db_migrations import VIEWS, staging_index_ddl, staging_index_renames, views_on
 from country_codes import eurostat_dictionary
 
 # Configura Logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # La connessione al database è ora gestita in db_config.py
 
+# API SDMX 2.1 di Eurostat: dati (TSV compresso) e metadati strutturali (dataflow, DSD)
+EUROSTAT_SDMX_URL = "https://ec.europa.eu/eurostat/api/dissemination/sdmx/2.1/"
+SDMX_NS = {
+    'm': "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message",
+    's': "http://www.sdmx.org/resources/sdmxml/schemas/v2_1/structure",
+}
+
+# Filtri per dimensione applicati lato server (dataset -> {dimensione: [codici]}).
+# L'endpoint 2.1 filtra solo tramite la chiave nel percorso (es. data/une_rt_a/.Y15-24+Y15-29..T.),
+# costruita nell'ordine delle dimensioni della DSD come fa il pacchetto eurostat.
+# Solo i sottoinsiemi usati dalla dashboard e dagli script di debug: meno byte da scaricare,
+# meno righe da rimodellare e caricare.
+DATASET_FILTERS = {
+    'unemployment': {
+        'age': ['Y15-24', 'Y15-29', 'Y15-74', 'Y25-74'], # Giovani vs Totale (Y15-74) e Adulti
+        'sex': ['T'],
+    },
+    'poverty_risk': {'sex': ['T']},
+    'leaving_home': {'sex': ['T']},
+}
+
+# Parametri di sessione per il caricamento. ETL one-shot: non serve attendere il flush del WAL
+# al commit; più memoria per gli ordinamenti della costruzione degli indici e di ANALYZE.
+LOAD_SETTINGS = {
+    'synchronous_commit': 'off',
+    'maintenance_work_mem': '1GB',
+    'work_mem': '256MB',
+}
+
+# Cache locale dei dataset grezzi: più esecuzioni nella stessa giornata non riscaricano nulla
+CACHE_DIR = Path('.cache')
+
+# Spazio + flag opzionale (es. ' b', ' p', ' ') alla fine di ogni cella del TSV
+FLAG_RE = re.compile(rb' [a-z]*(?=[\t\r\n]|\Z)')
+
+def get_cache_path(code, filters):
+    """
+    Percorso del dataset grezzo in cache, valido per la giornata corrente.
+    Il nome include un hash dei filtri SDMX: se cambiano, il dataset viene riscaricato.
+    """
+    filters_key = hashlib.sha1(json.dumps(filters, sort_keys=True).encode()).hexdigest()[:8]
+    return CACHE_DIR / f"{code}_{filters_key}_{date.today():%Y%m%d}.parquet"
+
+def parse_eurostat_tsv(body):
+    """
+    Converte il TSV restituito dall'API di Eurostat in un DataFrame nello stesso formato di
+    eurostat.get_data_df: una colonna per ogni metadato (unit, age, sex, geo\\TIME_PERIOD, ...)
+    e una colonna numerica per ogni anno.
+    """
+    # Il payload è un file gzip (compressed=true); gestisce anche risposte già decompresse
+    if body[:2] == b'\x1f\x8b':
+        body = gzip.decompress(body)
+
+    # Valori come '12.3 b' (con flag) o ': ' (mancante): togliamo spazio e flag a fine cella
+    # direttamente sui byte, così il parser C di read_csv legge subito le colonne come float
+    # (':' -> NaN) senza passare da stringhe e pd.to_numeric colonna per colonna.
+    body = FLAG_RE.sub(b'', body)
+
+    # La prima colonna raggruppa i metadati separati da virgola, es. 'freq,unit,sex,age,geo\\TIME_PERIOD'
+    header = body[:body.index(b'\n')].decode().rstrip('\r').split('\t')
+    first_col = header[0]
+    raw = pd.read_csv(
+        io.BytesIO(body), sep='\t', na_values=[':'], keep_default_na=False,
+        dtype={col: (str if col == first_col else np.float64) for col in header},
+    )
+
+    df_ids = raw.pop(first_col).str.split(',', expand=True)
+    df_ids.columns = first_col.split(',')
+    return pd.concat([df_ids, raw], axis=1)
+
+def clean_dataset(df):
+    """
+    Pulisce un dataset grezzo di Eurostat e lo trasforma in formato lungo (una riga per anno).
+    """
+    # Pulizia Base
+    # 1. Rinomina 'geo\time' o simili in standard 'geo' e trasforma anni
+    # La libreria Eurostat solitamente restituisce colonne come: unit, age, sex, geo\time, 2022, 2021...
+    # Nomi normalizzati in un solo passaggio, prima del reshape: minuscolo senza '\time',
+    # e qualunque colonna che contiene 'geo' (es. 'geo\TIME_PERIOD') diventa 'geo'.
+    df = df.rename(columns=lambda c: 'geo' if 'geo' in str(c).lower() else str(c).lower().replace('\\time', ''))
+    
+    # year e value nascono dal reshape; senza geo il dataset non è utilizzabile dalla dashboard
+    if 'geo' not in df.columns:
+        raise ValueError(f"No geo column in dataset columns: {list(df.columns)}")
+
+    # Separa metadati (geo, unit, ...) e colonne anno con una sola maschera vettoriale sulle colonne.
+    # Dopo il rename i nomi sono tutti stringhe, anche gli anni che la libreria restituisce come int.
+    cols = df.columns.to_numpy()
+    is_year = np.char.isdigit(cols.astype(str))
+    id_vars = cols[~is_year].tolist()
+    year_cols = cols[is_year].tolist()
+    
+    # Fondi le colonne annuali in righe per una più facile analisi SQL.
+    # Reshape NumPy invece di df.melt: nessuna colonna 'variable' di stringhe da riconvertire,
+    # anni e valori sono già numerici. Ogni riga di metadati si ripete una volta per anno.
+    n_years = len(year_cols)
+    # Anni e valori costruiti direttamente nei tipi finali, senza passate astype a posteriori:
+    # anni 1900-2100 stanno in int16, Eurostat pubblica al massimo un decimale (float32).
+    # pgpq li scrive come SMALLINT e REAL.
+    years = np.array([int(c) for c in year_cols], dtype=np.int16)
+    values = df.loc[:, is_year].to_numpy(dtype=np.float32, na_value=np.nan).ravel()
+
+    # Righe da tenere (valore presente e geo valorizzato) calcolate prima di costruire il frame:
+    # niente dropna che ricopia tutte le colonne dopo averle espanse.
+    keep = ~np.isnan(values) & np.repeat(df['geo'].notna().to_numpy(), n_years)
+    flat = np.flatnonzero(keep)
+    row_idx, year_idx = np.divmod(flat, n_years)
+
+    # I metadati (geo, age, sex, unit, ...) hanno poche decine di valori distinti ripetuti
+    # su migliaia di righe: come categorie occupano solo codici interi in memoria.
+    # Categorizzati sulle righe originali, poi si espandono solo i codici.
+    data = {}
+    for col in id_vars:
+        cat = pd.Categorical(df[col])
+        data[col] = pd.Categorical.from_codes(cat.codes[row_idx], dtype=cat.dtype)
+    data['year'] = pd.array(years[year_idx], dtype='Int16')
+    data['value'] = pd.array(values[flat], dtype='Float32')
+    df_melted = pd.DataFrame(data)
+
+    return df_melted
+
+def parse_and_clean(body, cache_path):
+    """
+    Parsing + pulizia (CPU-bound): eseguito in un processo separato.
+    Con body=None il dataset grezzo viene letto dalla cache, altrimenti viene salvato in cache.
+    """
+    if body is None:
+        df = pd.read_parquet(cache_path)
+    else:
+        df = parse_eurostat_tsv(body)
+        cache_path.parent.mkdir(exist_ok=True)
+        df.to_parquet(cache_path, compression='zstd')
+        # Rimuovi le copie dei giorni precedenti (o con altri filtri) dello stesso dataset
+        for stale in cache_path.parent.glob(cache_path.name.rsplit('_', 2)[0] + '_*.parquet'):
+            if stale != cache_path:
+                stale.unlink()
+    return clean_dataset(df)
+
+async def fetch_xml(session, url):
+    """Scarica un messaggio strutturale SDMX e ne restituisce la radice XML."""
+    async with session.get(url) as response:
+        response.raise_for_status()
+        return ET.fromstring(await response.read())
+
+async def fetch_dimensions(session, code):
+    """Identificativi delle dimensioni del dataset, nell'ordine (position) della sua DSD."""
+    dataflow = await fetch_xml(session, f"{EUROSTAT_SDMX_URL}dataflow/ESTAT/{code}/latest")
+    dsd_id = dataflow.find('m:Structures/s:Dataflows/s:Dataflow/s:Structure/Ref', SDMX_NS).get('id')
+    dsd = await fetch_xml(session, f"{EUROSTAT_SDMX_URL}datastructure/ESTAT/{dsd_id}/latest")
+    dimensions = dsd.findall(
+        'm:Structures/s:DataStructures/s:DataStructure/s:DataStructureComponents/s:DimensionList/s:Dimension',
+        SDMX_NS,
+    )
+    return [dim.get('id') for dim in sorted(dimensions, key=lambda dim: int(dim.get('position')))]
+
+def build_sdmx_key(dimensions, filters):
+    """
+    Chiave SDMX 2.1 per `filters`: un segmento per dimensione separato da '.', più codici uniti
+    da '+', segmento vuoto per le dimensioni non filtrate (es. '.Y15-24+Y15-29..T.').
+    """
+    filters = {dim.lower(): codes for dim, codes in filters.items()}
+    unknown = set(filters) - {dim.lower() for dim in dimensions}
+    if unknown:
+        raise ValueError(f"Unknown SDMX dimensions {sorted(unknown)}, available: {dimensions}")
+    return '.'.join('+'.join(filters.get(dim.lower(), [])) for dim in dimensions)
+
+async def fetch_dataset(session, code, filters):
+    """
+    Scarica il TSV compresso di un dataset dall'API di Eurostat.
+    `filters` ({dimensione: [codici]}) viene applicato lato server: arrivano solo le righe utili.
+    """
+    url = f"{EUROSTAT_SDMX_URL}data/{code}"
+    if filters:
+        url += "/" + build_sdmx_key(await fetch_dimensions(session, code), filters)
+    async with session.get(url, params={'format': 'TSV', 'compressed': 'true'}) as response:
+        response.raise_for_status()
+        return await response.read()
+
+def make_process_pool(n_workers):
+    """
+    Pool di processi per la pulizia. Su POSIX usa 'forkserver': i worker nascono da un server
+    a thread singolo (mai da un processo con thread attivi, come il thread asyncio o il resolver
+    DNS di aiohttp) e pandas/numpy/pyarrow vengono importati una volta sola nel server.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        ctx = multiprocessing.get_context('forkserver')
+        ctx.set_forkserver_preload(['numpy', 'pandas', 'pyarrow'])
+    else:
+        ctx = multiprocessing.get_context()
+    return ProcessPoolExecutor(max_workers=n_workers, mp_context=ctx)
+
+async def fetch_and_clean_all(datasets, pool, on_ready):
+    """
+    Scarica tutti i dataset in parallelo (I/O-bound, asyncio) e li pulisce nel pool di processi
+    `pool` (CPU-bound), così la pulizia di un dataset si sovrappone al download degli altri.
+    Ogni dataset pronto viene consegnato subito a `on_ready((nome, DataFrame))`.
+    """
+    loop = asyncio.get_running_loop()
+    connector = aiohttp.TCPConnector(limit_per_host=4)
+
+    async with aiohttp.ClientSession(connector=connector) as session:
+
+        async def process(name, code):
+            filters = DATASET_FILTERS.get(name, {})
+            cache_path = get_cache_path(code, filters)
+            if cache_path.exists():
+                logger.info("Using cached dataset: %s (%s)...", name, cache_path)
+                body = None
+            else:
+                logger.info("Fetching dataset: %s (%s)...", name, code)
+                # Solo gli errori di rete saltano il dataset (la tabella nel DB resta quella
+                # precedente); errori di parsing o pulizia interrompono l'intero ETL.
+                try:
+                    body = await fetch_dataset(session, code, filters)
+                except (aiohttp.ClientError, asyncio.TimeoutError):
+                    logger.exception("Error downloading %s (%s)", name, code)
+                    return
+            df = await loop.run_in_executor(pool, parse_and_clean, body, cache_path)
+            if df.empty:
+                logger.warning("Dataset %s (%s) is empty after cleaning, skipping.", name, code)
+                return
+            logger.info("Dataset %s processed. Shape: %s", name, df.shape)
+            on_ready((name, df))
+
+        await asyncio.gather(*(process(name, code) for name, code in datasets.items()))
+
 def fetch_and_clean_data():
     """
-    Recupera i dati da Eurostat, li pulisce e restituisce un dizionario di DataFrame.
+    Generatore: recupera i dati da Eurostat, li pulisce e restituisce le coppie (nome, DataFrame)
+    man mano che ogni dataset è pronto. Download e pulizia proseguono in un thread separato
+    mentre il chiamante carica nel DB i dataset già pronti. Un DataFrame resta in memoria solo
+    finché è in coda o in caricamento: la coda non è limitata (un put bloccante fermerebbe il
+    loop asyncio), quindi se la pulizia è più veloce del COPY più dataset possono attendere insieme.
     """
     datasets = {
         'unemployment': 'une_rt_a',
@@ -35,94 +284,165 @@ def fetch_and_clean_data():
         'housing_cost': 'tessi161' # Riferimento per il tasso di sovraccarico del costo dell'alloggio
     }
 
-    cleaned_data = {}
+    ready = queue.Queue()
+    errors = []
 
-    for name, code in datasets.items():
-        logging.info(f"Fetching dataset: {name} ({code})...")
+    # Pool e loop creati nel thread principale, prima di avviare il thread di download
+    with make_process_pool(len(datasets)) as pool: # Un worker per dataset (sono indipendenti)
+        loop = asyncio.new_event_loop()
+        task = loop.create_task(fetch_and_clean_all(datasets, pool, ready.put))
+
+        def run():
+            try:
+                loop.run_until_complete(task)
+            except asyncio.CancelledError:
+                pass # Interrotto dal chiamante
+            except Exception as e:
+                errors.append(e) # Rilanciata nel thread del chiamante
+            finally:
+                loop.run_until_complete(loop.shutdown_default_executor())
+                ready.put(None) # Segnale di fine
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
         try:
-            # Recupera dati come DataFrame
-            df = eurostat.get_data_df(code)
-            
-            # Pulizia Base
-            # 1. Rinomina 'geo\time' o simili in standard 'geo' e trasforma anni
-            # La libreria Eurostat solitamente restituisce colonne come: unit, age, sex, geo\time, 2022, 2021...
-            
-            # Identifica colonne che non sono anni (solitamente metadati)
-            # Spesso finiscono con '\time' o sono chiamate 'geo', 'unit', ecc.
-            id_vars = [col for col in df.columns if not str(col).isdigit() and not isinstance(col, int)]
-            
-            # Fondi le colonne annuali in righe per una più facile analisi SQL
-            df_melted = df.melt(id_vars=id_vars, var_name='year', value_name='value')
-            
-            # Converti anno e valore in numerico, forzando errori
-            df_melted['year'] = pd.to_numeric(df_melted['year'], errors='coerce')
-            df_melted['value'] = pd.to_numeric(df_melted['value'], errors='coerce')
-            
-            # Standardizza nomi colonne: minuscolo e sostituzione caratteri specifici
-            df_melted.columns = [c.lower().replace('\\time', '') for c in df_melted.columns]
-            
-            # Rinomina 'geo' se esiste (a volte è puramente 'geo', a volte 'geo\time')
-            if 'geo' not in df_melted.columns:
-                 # Prova a trovare una colonna che contiene 'geo'
-                 geo_col = next((c for c in df_melted.columns if 'geo' in c), None)
-                 if geo_col:
-                     df_melted.rename(columns={geo_col: 'geo'}, inplace=True)
-
-            # Rimuovi righe con valori NaN in colonne critiche
-            df_melted.dropna(subset=['year', 'value', 'geo'], inplace=True)
-            
-            # Logica di Filtro Specifica basata sul tipo di dataset
-            if name == 'unemployment':
-                # Filtra per gruppi d'età rilevanti se la colonna 'age' esiste
-                if 'age' in df_melted.columns:
-                    # Mantieni Y15-24, Y15-29, Y25-74 (Confronto Adulti), e TOTAL
-                    # Nota: Potresti dover controllare i codici effettivi nei dati
-                    relevant_ages = ['Y15-24', 'Y15-29', 'Y25-74', 'TOTAL'] 
-                    # Filtra solo se i valori sono presenti, per evitare df vuoti se i codici differiscono
-                    # Per semplicità in questo script generico, manteniamo tutto ma logghiamo una nota
-                    # Mondo reale: df_melted = df_melted[df_melted['age'].isin(relevant_ages)]
-                    pass
-
-            cleaned_data[name] = df_melted
-            logging.info(f"Dataset {name} processed. Shape: {df_melted.shape}")
-
-        except Exception as e:
-            logging.error(f"Error processing {name} ({code}): {e}")
+            # pop() prima dello yield: mentre il chiamante carica un dataset il generatore non
+            # ne trattiene alcun riferimento, così il DataFrame si libera appena il chiamante lo rilascia
+            pending = [ready.get()]
+            while pending[0] is not None:
+                yield pending.pop()
+                pending.append(ready.get())
+        finally:
+            # Se il chiamante si interrompe (es. errore nel caricamento) ferma download e pulizie
+            # ancora in corso invece di lasciarle proseguire fino all'uscita del processo.
+            # Dopo un completamento normale cancel() non ha effetto.
+            loop.call_soon_threadsafe(task.cancel)
+            worker.join()
+            loop.close()
+            pool.shutdown(cancel_futures=True)
+    if errors:
+        raise errors[0]
     
     # Elabora Dizionario Codici Paese
-    try:
-        logging.info("Processing Country Codes...")
-        df_codes = pd.DataFrame(list(eurostat_dictionary.items()), columns=['geo', 'country_name'])
-        cleaned_data['country_codes'] = df_codes
-        logging.info(f"Country Codes processed. Shape: {df_codes.shape}")
-    except Exception as e:
-        logging.error(f"Error processing Country Codes: {e}")
+    logger.info("Processing Country Codes...")
+    # Due array densi (uno per colonna) invece di una lista di tuple da riscomporre
+    n_codes = len(eurostat_dictionary)
+    df_codes = pd.DataFrame({
+        'geo': np.fromiter(eurostat_dictionary.keys(), dtype=object, count=n_codes),
+        'country_name': np.fromiter(eurostat_dictionary.values(), dtype=object, count=n_codes),
+    })
+    logger.info("Country Codes processed. Shape: %s", df_codes.shape)
+    yield 'country_codes', df_codes
+
+def execute_batch(cur, statements):
+    """
+    Invia più istruzioni DDL in un unico messaggio (simple query protocol): un solo round-trip
+    verso il database remoto invece di uno per istruzione.
+    """
+    cur.execute(";\n".join(statements))
+
+def copy_to_staging(cur, table_name, df):
+    """
+    Copia il DataFrame nella tabella di staging UNLOGGED `{table_name}_stg` con COPY FROM STDIN binario.
+    Il DataFrame viene convertito in Arrow e codificato direttamente nel formato binario di Postgres
+    (pgpq): niente conversione float -> testo -> float come nel CSV. UNLOGGED: niente WAL per riga.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    # Le colonne categoriche arrivano come dictionary Arrow: l'encoder vuole testo semplice,
+    # quindi le espandiamo in Arrow (categories[codes]) senza ripassare da oggetti Python
+    table = pa.table(
+        [col.cast(col.type.value_type) if pa.types.is_dictionary(col.type) else col for col in table.columns],
+        names=table.column_names,
+    )
+    encoder = ArrowToPostgresBinaryEncoder(table.schema)
+
+    # DDL esplicito derivato dallo schema Arrow (tipi Postgres scelti dall'encoder)
+    pg_schema = encoder.schema()
+    columns_ddl = ", ".join(f'"{column.name}" {column.data_type.ddl()}' for column in pg_schema.columns)
 
-    return cleaned_data
+    buf = io.BytesIO()
+    buf.write(encoder.write_header())
+    for batch in table.to_batches():
+        buf.write(encoder.write_batch(batch))
+    buf.write(encoder.finish())
+    buf.seek(0)
 
-def load_to_postgres(data_dict, engine):
+    staging = f"{table_name}_stg"
+    execute_batch(cur, [
+        f"DROP TABLE IF EXISTS {staging}",
+        f"CREATE UNLOGGED TABLE {staging} ({columns_ddl})",
+    ])
+    cur.copy_expert(f"COPY {staging} FROM STDIN WITH (FORMAT BINARY)", buf)
+
+def finalize_staging(cur, table_name):
     """
-    Carica i DataFrame puliti in PostgreSQL.
+    Prepara la tabella di staging già popolata: la rende LOGGED, costruisce gli indici e aggiorna
+    le statistiche. Tutto prima dello scambio, sulle tabelle che la dashboard non legge ancora.
     """
-    for table_name, df in data_dict.items():
-        try:
-            logging.info(f"Loading {table_name} to database...")
-            df.to_sql(table_name, engine, if_exists='replace', index=False)
-            logging.info(f"Successfully loaded {table_name}.")
-        except Exception as e:
-            logging.error(f"Failed to load {table_name}: {e}")
+    staging = f"{table_name}_stg"
+    # SET LOGGED riscrive la tabella: va fatto prima degli indici, altrimenti verrebbero ricostruiti
+    execute_batch(cur, [
+        f"ALTER TABLE {staging} SET LOGGED",
+        *staging_index_ddl(table_name),
+        f"ANALYZE {staging}",
+    ])
+
+def swap_staging_tables(cur, table_names):
+    """
+    Sostituisce le tabelle pubblicate con quelle di staging e ricrea le viste costruite su di esse.
+    I lock sulle tabelle lette dalla dashboard vengono presi solo qui, alla fine del caricamento,
+    e coprono solo rinomine e le viste materializzate.
+    """
+    # Solo le viste delle tabelle effettivamente caricate: se un download è saltato la sua
+    # tabella (e la vista che ne dipende) resta quella precedente.
+    views = views_on(table_names)
+    # Viste rimosse esplicitamente e DROP TABLE senza CASCADE: un altro oggetto dipendente
+    # inatteso fa fallire lo scambio invece di sparire in silenzio.
+    statements = [f"DROP MATERIALIZED VIEW IF EXISTS {view}" for view in views]
+    for table_name in table_names:
+        statements.append(f"DROP TABLE IF EXISTS {table_name}")
+        statements.append(f"ALTER TABLE {table_name}_stg RENAME TO {table_name}")
+        statements.extend(staging_index_renames(table_name))
+    for view in views:
+        statements.extend(VIEWS[view][1])
+    execute_batch(cur, statements)
+
+def load_to_postgres(datasets, engine):
+    """
+    Carica in PostgreSQL le coppie (nome tabella, DataFrame) di `datasets` (anche un generatore).
+    Ogni DataFrame viene copiato in una tabella di staging UNLOGGED e rilasciato subito; a fine
+    caricamento le tabelle di staging sostituiscono quelle pubblicate. Tutto avviene in un'unica
+    transazione: se l'ETL fallisce restano intatti i dati precedenti.
+    """
+    loaded = []
+    with engine.begin() as conn:
+        cur = conn.connection.cursor()
+        # SET LOCAL: valgono solo per questa transazione, nessuna modifica alla configurazione del server
+        execute_batch(cur, [f"SET LOCAL {name} = '{value}'" for name, value in LOAD_SETTINGS.items()])
+        for table_name, df in datasets:
+            logger.info("Loading %s to database...", table_name)
+            copy_to_staging(cur, table_name, df)
+            # Ultimo riferimento al DataFrame (il generatore non ne trattiene): liberato prima
+            # della costruzione degli indici e dell'attesa del dataset successivo
+            del df
+            finalize_staging(cur, table_name)
+            loaded.append(table_name)
+            logger.info("Successfully loaded %s.", table_name)
+
+        logger.info("Swapping staging tables and rebuilding materialized views...")
+        swap_staging_tables(cur, loaded)
 
 if __name__ == "__main__":
-    logging.info("Starting ETL process...")
-    
-    # 1. Recupera e Pulisci
-    data = fetch_and_clean_data()
+    logger.info("Starting ETL process...")
     
-    # 2. Carica nel DB
+    # Recupera, pulisci e carica nel DB in pipeline: ogni dataset viene copiato appena pronto
     # NOTA: Usiamo la configurazione da db_config.py
     try:
         engine = get_db_engine()
-        load_to_postgres(data, engine)
-        logging.info("ETL process finished successfully. Data loaded to DB.")
-    except Exception as e:
-         logging.error(f"ETL failed during DB load: {e}")
+        # closing(): se il caricamento fallisce il generatore viene chiuso subito, fermando i download
+        with closing(fetch_and_clean_data()) as datasets:
+            load_to_postgres(datasets, engine)
+        logger.info("ETL process finished successfully. Data loaded to DB.")
+    except Exception:
+        logger.exception("ETL failed during DB load")
+        raise